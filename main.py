@@ -1,318 +1,421 @@
-from fastapi import FastAPI, Request, Depends
-from fastapi.responses import PlainTextResponse
-from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from cachetools import LRUCache, TTLCache
+import asyncio
+from fastapi import FastAPI, Request, Depends, BackgroundTasks
+from fastapi.responses import PlainTextResponse, ORJSONResponse
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 import httpx
 import logging
-import json
+import logging.handlers
+import queue
+import orjson
 import os
 
 from models import WahaNode, WaSession, ContactContainer
-from database import get_db, init_nodes
+from database import SessionLocal, init_schema, init_nodes, load_nodes_by_container
+from node_allocator import pick_node, release_node
 from schemas import SendMessageRequest, CreateSessionRequest
 
-logging.basicConfig(level=logging.INFO)
+# Records are still formatted on the event loop (QueueHandler.prepare); only the stream write
+# moves to the background listener thread. The queue side merges args into the message only,
+# the listener's handler applies the full format once.
+log_queue = queue.SimpleQueue()
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+logging.getLogger().addHandler(log_queue_handler)
+logging.getLogger().setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="WAHA WhatsApp Bot", version="2.0.0")
+# contact_id -> [(container_number, node)]; cache operations never await, so no lock is needed
+contact_cache = TTLCache(maxsize=10_000, ttl=600)
+# LID contact_id -> phone number; LIDs are stable per contact so entries never expire
+lid_phone_cache = LRUCache(maxsize=50_000)
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize WAHA nodes in database if they don't exist"""
-    init_nodes()
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+pending_tasks = set()
+
+def fire_and_forget(coro) -> None:
+    """Schedule a coroutine without awaiting it"""
+    task = asyncio.create_task(coro)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize WAHA nodes and a shared pooled HTTP client for WAHA calls"""
+    log_listener.start()
+    # Schema is normally created by `python database.py` before workers start
+    if os.getenv("RUN_MIGRATIONS", "").lower() in ("1", "true", "yes"):
+        await init_schema()
+    await init_nodes()
+    app.state.nodes_by_container = await load_nodes_by_container()
+    if not app.state.nodes_by_container:
+        # Without nodes every contact lookup fails and LIDs never resolve, so don't start half-working
+        logger.error("No WAHA nodes with a container_number found; run `python database.py` and check waha_nodes")
+        log_listener.stop()  # Flush the queued error before startup aborts
+        raise RuntimeError("No WAHA nodes with a container_number found")
+    refresh_container_mapping(app)
+    # HTTP/2 multiplexes concurrent sends over one connection per WAHA host when it is reachable over TLS
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=256, keepalive_expiry=120),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        log_listener.stop()
+
+app = FastAPI(title="WAHA WhatsApp Bot", version="2.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Return the shared WAHA HTTP client created in lifespan"""
+    return request.app.state.http
 
 @app.get("/")
 def root():
     return {"message": "WhatsApp Bot is ready!"}
 
 @app.post("/session/create")
-async def create_session(request: CreateSessionRequest, db: Session = Depends(get_db)):
-    """Create a new WhatsApp session and assign it to a WAHA node (round-robin)"""
+async def create_session(request: CreateSessionRequest, client: httpx.AsyncClient = Depends(get_http_client)):
+    """Create a new WhatsApp session and assign it to the least-loaded WAHA node"""
     phone = request.phone
-    logger.info(f"-------SESSION_CREATE_START---{phone}----")
-    
-    # Check if session already exists
-    existing = db.query(WaSession).filter_by(phone=phone).first()
-    if existing:
-        logger.warning(f"-------SESSION_EXISTS---{phone}----")
-        return {"status": "error", "message": f"Session for {phone} already exists"}
-    
-    # Simple round-robin: alternate between containers
-    total_sessions = db.query(WaSession).count()
-    container_number = (total_sessions % 2) + 1  # Alternate between 1 and 2
-    logger.info(f"-------CONTAINER_SELECTED---{container_number}---{phone}----")
-    
-    # Get the node for this container
-    node = db.query(WahaNode).filter(
-        WahaNode.url.like(f"%waha_core_{container_number}%")
-    ).first()
-    
-    if not node:
-        logger.error(f"-------CONTAINER_NOT_FOUND---{container_number}----")
-        return {"status": "error", "message": f"WAHA container {container_number} not found"}
+    logger.debug("-------SESSION_CREATE_START---%s----", phone)
+    
+    # Hold a DB connection only around the queries, never across the WAHA call
+    async with SessionLocal() as db:
+        # Check if session already exists
+        existing = (await db.execute(select(WaSession).where(WaSession.phone == phone))).scalars().first()
+        if existing:
+            logger.warning("-------SESSION_EXISTS---%s----", phone)
+            return {"status": "error", "message": f"Session for {phone} already exists"}
+        
+        # Reserve a slot on the least-loaded node; committed now so the row lock isn't held across the WAHA call
+        node = await pick_node(db)
+        if not node:
+            logger.error("-------NO_NODE_CAPACITY---%s----", phone)
+            return {"status": "error", "message": "No WAHA container has free capacity"}
+        await db.commit()
+    container_number = node.container_number
+    logger.debug("-------CONTAINER_SELECTED---%s---%s----", container_number, phone)
     
     # Create session in WAHA
     try:
-        logger.info(f"-------WAHA_SESSION_CREATE---{phone}---{node.url}----")
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{node.url}/api/sessions",
-                headers={"X-Api-Key": node.api_key},
-                json={"name": phone},
-                timeout=30
-            )
-            response.raise_for_status()
-        logger.info(f"-------WAHA_SESSION_CREATED---{phone}---{node.url}----")
+        logger.debug("-------WAHA_SESSION_CREATE---%s---%s----", phone, node.url)
+        response = await client.post(
+            f"{node.url}/api/sessions",
+            headers={"X-Api-Key": node.api_key},
+            json={"name": phone},
+            timeout=30
+        )
+        response.raise_for_status()
+        logger.debug("-------WAHA_SESSION_CREATED---%s---%s----", phone, node.url)
     except Exception as e:
-        logger.error(f"-------WAHA_SESSION_CREATE_FAILED---{phone}---{str(e)}----")
+        logger.error("-------WAHA_SESSION_CREATE_FAILED---%s---%s----", phone, e)
+        async with SessionLocal() as db:
+            await release_node(db, node.id)
+            await db.commit()
         return {"status": "error", "message": str(e)}
     
     # Store session in database
-    db_session = WaSession(phone=phone, session_name=phone, node_id=node.id)
-    db.add(db_session)
-    db.commit()
+    async with SessionLocal() as db:
+        db.add(WaSession(phone=phone, session_name=phone, node_id=node.id))
+        await db.commit()
     
-    logger.info(f"-------SESSION_CREATE_SUCCESS---{phone}---{container_number}----")
+    logger.info("-------SESSION_CREATE_SUCCESS---%s---%s----", phone, container_number)
     return {"status": "success", "assigned_to": node.url, "container": container_number, "phone": phone}
 
+MAPPING_FILE = os.path.join(os.path.dirname(__file__), "contact_container_mapping.json")
+
 def load_container_mapping() -> dict:
     """Load container to contacts mapping from JSON file (container -> [contacts])"""
-    mapping_file = os.path.join(os.path.dirname(__file__), "contact_container_mapping.json")
     try:
-        with open(mapping_file, 'r') as f:
-            return json.load(f)
+        with open(MAPPING_FILE, 'rb') as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
-        logger.warning(f"Mapping file not found: {mapping_file}, using empty mapping")
+        logger.warning("Mapping file not found: %s, using empty mapping", MAPPING_FILE)
         return {}
-    except json.JSONDecodeError:
-        logger.error(f"Invalid JSON in mapping file: {mapping_file}")
+    except orjson.JSONDecodeError:
+        logger.error("Invalid JSON in mapping file: %s", MAPPING_FILE)
         return {}
 
-async def resolve_lid_to_phone_via_waha(contact_id: str, session: str, node: WahaNode) -> str:
+def invert_container_mapping(json_mapping: dict) -> dict:
+    """Invert container -> [phone_numbers] into phone_number -> [container_numbers]"""
+    phone_to_containers = {}
+    for container_str, phone_numbers in json_mapping.items():
+        container_num = int(container_str)
+        for phone in phone_numbers:
+            containers = phone_to_containers.setdefault(phone, [])
+            if container_num not in containers:
+                containers.append(container_num)
+    return phone_to_containers
+
+def refresh_container_mapping(app: FastAPI) -> dict:
+    """Return the cached phone -> containers mapping, reloading it only if the file changed"""
+    try:
+        mtime = os.stat(MAPPING_FILE).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if getattr(app.state, "mapping_mtime", 0) != mtime:
+        app.state.phone_to_containers = invert_container_mapping(load_container_mapping())
+        app.state.mapping_mtime = mtime
+    return app.state.phone_to_containers
+
+LID_SUFFIX = "@lid"
+
+@lru_cache(maxsize=10_000)
+def parse_contact(contact_id: str) -> tuple:
+    """Split a WhatsApp id into (local part, suffix), e.g. "123@lid" -> ("123", "@lid"); bare ids get an empty suffix"""
+    local, sep, domain = contact_id.rpartition("@")
+    if not sep:
+        return contact_id, ""
+    return local, sep + domain
+
+async def resolve_lid_to_phone_via_waha(contact_id: str, session: str, node: WahaNode, client: httpx.AsyncClient) -> str:
     """Resolve LID to phone number using WAHA API: GET /api/{session}/lids/{lid}"""
-    if "@lid" not in contact_id:
-        return contact_id.split("@")[0] if "@" in contact_id else contact_id
+    lid, suffix = parse_contact(contact_id)
+    if suffix != LID_SUFFIX:
+        return lid
     
-    lid = contact_id.split("@")[0]
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{node.url}/api/{session}/lids/{lid}",
-                headers={"X-Api-Key": node.api_key},
-                timeout=10
-            )
-            if response.status_code == 200:
-                data = response.json()
-                phone = data.get("pn", "").split("@")[0] if "@" in data.get("pn", "") else None
-                if phone:
-                    logger.info(f"-------LID_RESOLVED_VIA_WAHA---{contact_id}---{phone}----")
-                    return phone
+        response = await client.get(
+            f"{node.url}/api/{session}/lids/{lid}",
+            headers={"X-Api-Key": node.api_key},
+            timeout=10
+        )
+        if response.status_code == 200:
+            data = response.json()
+            pn_local, pn_suffix = parse_contact(data.get("pn") or "")
+            phone = pn_local if pn_suffix else None
+            if phone:
+                logger.info("-------LID_RESOLVED_VIA_WAHA---%s---%s----", contact_id, phone)
+                return phone
     except Exception as e:
-        logger.warning(f"-------LID_RESOLUTION_FAILED---{contact_id}---{str(e)}----")
+        logger.warning("-------LID_RESOLUTION_FAILED---%s---%s----", contact_id, e)
     
     # Fallback: return LID number
-    return contact_id.split("@")[0]
+    return lid
 
-def get_phone_from_contact(contact_id: str, db: Session) -> str:
-    """Extract phone number from contact_id and check database for LID mapping"""
+async def get_phone_from_contact(contact_id: str, client: httpx.AsyncClient) -> str:
+    """Extract phone number from contact_id, resolving LIDs via the WAHA API (at most once per LID)"""
     # Extract phone/LID from contact_id
-    phone_or_lid = contact_id.split("@")[0] if "@" in contact_id else contact_id
-    
-    # Check if this contact_id exists in database with phone_number
-    existing = db.query(ContactContainer).filter_by(contact_id=contact_id).first()
-    if existing and existing.phone_number:
-        logger.info(f"-------PHONE_FROM_DB---{contact_id}---{existing.phone_number}----")
-        return existing.phone_number
+    phone_or_lid, suffix = parse_contact(contact_id)
     
-    # For @c.us format, phone is the extracted part
-    if "@c.us" in contact_id:
+    # For @c.us (and bare) format, phone is the extracted part
+    if suffix != LID_SUFFIX:
         return phone_or_lid
     
-    # For @lid format, return LID number (will be resolved via WAHA API when storing)
-    if "@lid" in contact_id:
-        logger.info(f"-------LID_DETECTED---{contact_id}---{phone_or_lid}----")
+    cached = lid_phone_cache.get(contact_id)
+    if cached:
+        return cached
     
-    # Return extracted phone/LID (will be used for matching)
+    logger.debug("-------LID_DETECTED---%s---%s----", contact_id, phone_or_lid)
+    
+    # Only called once the contact has no stored mappings, so there is no stored phone to look up;
+    # resolve via WAHA API using any session and node
+    node = next(iter(app.state.nodes_by_container.values()), None)
+    if not node:
+        return phone_or_lid
+    async with SessionLocal() as db:
+        session_obj = (await db.execute(select(WaSession).limit(1))).scalars().first()
+    session_name = session_obj.phone if session_obj else "default"
+    phone_number = await resolve_lid_to_phone_via_waha(contact_id, session_name, node, client)
+    if phone_number and phone_number != phone_or_lid:
+        lid_phone_cache[contact_id] = phone_number
+        return phone_number
+    
+    # Unresolved: fall back to the LID number (not cached so it is retried next time)
     return phone_or_lid
 
-async def get_container_for_contact(contact_id: str, db: Session) -> tuple:
-    """Get container number and node for a contact (container -> phone numbers mapping from JSON)"""
-    logger.info(f"-------CONTAINER_LOOKUP_START---{contact_id}----")
+async def get_contact_mappings(contact_id: str, db: AsyncSession) -> list:
+    """Get (ContactContainer, WahaNode) rows for a contact in a single joined query"""
+    result = await db.execute(
+        select(ContactContainer, WahaNode)
+        .join(WahaNode, WahaNode.id == ContactContainer.node_id)
+        .where(ContactContainer.contact_id == contact_id)
+    )
+    return result.all()
+
+async def get_container_for_contact(contact_id: str, client: httpx.AsyncClient) -> tuple:
+    """Get the first (container number, node) for a contact"""
+    containers = await get_containers_for_contact(contact_id, client)
+    return containers[0]
+
+async def get_containers_for_contact(contact_id: str, client: httpx.AsyncClient) -> list:
+    """Get all (container number, node) pairs for a contact (container -> phone numbers mapping from JSON)"""
+    logger.debug("-------CONTAINER_LOOKUP_START---%s----", contact_id)
+    
+    cached = contact_cache.get(contact_id)
+    if cached:
+        return cached
     
     # Check if contact already assigned to containers in database
-    contact_mappings = db.query(ContactContainer).filter_by(contact_id=contact_id).all()
+    async with SessionLocal() as db:
+        contact_mappings = await get_contact_mappings(contact_id, db)
     
     if contact_mappings:
         # Contact already mapped, return all containers
         containers = []
-        for mapping in contact_mappings:
-            node = db.query(WahaNode).get(mapping.node_id)
-            if node:
-                containers.append((mapping.container_number, node))
-                logger.info(f"-------CONTAINER_FOUND_IN_DB---{contact_id}---{mapping.container_number}----")
-        
-        if containers:
-            # Return first container for now (you can modify to return all or handle multiple)
-            return containers[0]
-    
-    # Contact not in DB, check JSON mapping file (container -> [phone_numbers])
-    logger.info(f"-------CHECKING_JSON_MAPPING---{contact_id}----")
-    json_mapping = load_container_mapping()
-    container_numbers = []
-    
-    # Get phone number (handles LID -> phone mapping via database)
-    phone_number = get_phone_from_contact(contact_id, db)
-    logger.info(f"-------PHONE_RESOLVED---{contact_id}---{phone_number}----")
-    
-    # If LID format and not resolved yet, resolve via WAHA API BEFORE matching JSON
-    if "@lid" in contact_id:
-        # Check if we have stored phone@c.us format for this LID in DB
-        stored_contact = db.query(ContactContainer).filter_by(contact_id=contact_id).first()
-        if stored_contact and stored_contact.phone_number:
-            # Already resolved and stored
-            phone_number = stored_contact.phone_number
-            logger.info(f"-------LID_ALREADY_RESOLVED_IN_DB---{contact_id}---{phone_number}----")
-        else:
-            # Not resolved yet - resolve via WAHA API
-            session_obj = db.query(WaSession).first()
-            session_name = session_obj.phone if session_obj else "default"
-            # Get first node to resolve (we'll get correct node later)
-            node = db.query(WahaNode).first()
-            if node:
-                resolved_phone = await resolve_lid_to_phone_via_waha(contact_id, session_name, node)
-                if resolved_phone and resolved_phone != phone_number:
-                    phone_number = resolved_phone
-                    logger.info(f"-------LID_RESOLVED_BEFORE_MATCHING---{contact_id}---{phone_number}----")
-    
-    # Search through containers to find all containers that have this phone number
-    for container_str, phone_numbers in json_mapping.items():
-        logger.info(f"-------CHECKING_CONTAINER---{container_str}---{phone_numbers}----")
-        # JSON now has phone numbers only (no @c.us or @lid)
-        if phone_number in phone_numbers:
-            container_num = int(container_str)
-            if container_num not in container_numbers:
-                container_numbers.append(container_num)
-                logger.info(f"-------CONTAINER_FOUND_IN_JSON---{contact_id}---{phone_number}---{container_num}----")
-    
-    
-    if not container_numbers:
+        for mapping, node in contact_mappings:
+            containers.append((mapping.container_number, node))
+            logger.debug("-------CONTAINER_FOUND_IN_DB---%s---%s----", contact_id, mapping.container_number)
+        contact_cache[contact_id] = containers
+        return containers
+    
+    # Contact not in DB, check cached JSON mapping (phone_number -> [containers])
+    logger.debug("-------CHECKING_JSON_MAPPING---%s----", contact_id)
+    phone_to_containers = refresh_container_mapping(app)
+    
+    # Get phone number once (handles LID -> phone mapping via database or WAHA)
+    phone_number = await get_phone_from_contact(contact_id, client)
+    logger.debug("-------PHONE_RESOLVED---%s---%s----", contact_id, phone_number)
+    
+    # JSON has phone numbers only (no @c.us or @lid)
+    container_numbers = list(phone_to_containers.get(phone_number, []))
+    if container_numbers:
+        logger.debug("-------CONTAINER_FOUND_IN_JSON---%s---%s---%s----", contact_id, phone_number, container_numbers)
+    else:
         # Not in JSON either, use default logic (last digit)
-        phone = contact_id.split("@")[0] if "@" in contact_id else contact_id
+        phone, _ = parse_contact(contact_id)
         last_digit = int(phone[-1]) if phone and phone[-1].isdigit() else 0
         container_num = 1 if last_digit < 5 else 2
         container_numbers = [container_num]
-        logger.warning(f"-------CONTAINER_DEFAULT_LOGIC---{contact_id}---{container_num}----")
+        logger.warning("-------CONTAINER_DEFAULT_LOGIC---%s---%s----", contact_id, container_num)
     
     # Get nodes for all containers and store mappings
     containers = []
-    for container_number in container_numbers:
-        # Validate container number
-        if container_number not in [1, 2]:
-            logger.error(f"-------INVALID_CONTAINER---{contact_id}---{container_number}----")
-            continue
-        
-        # Get the node for this container
-        node = db.query(WahaNode).filter(
-            WahaNode.url.like(f"%waha_core_{container_number}%")
-        ).first()
-        
-        if not node:
-            logger.error(f"-------CONTAINER_NODE_NOT_FOUND---{container_number}----")
-            continue
-        
-        # Store mapping in database (if not already exists)
-        existing = db.query(ContactContainer).filter_by(
-            contact_id=contact_id,
-            container_number=container_number
-        ).first()
-        
-        if not existing:
-            # Get phone number for this contact
-            phone_number = get_phone_from_contact(contact_id, db)
+    async with SessionLocal() as db:
+        for container_number in container_numbers:
+            # Validate container number
+            if container_number not in [1, 2]:
+                logger.error("-------INVALID_CONTAINER---%s---%s----", contact_id, container_number)
+                continue
             
-            # If LID format, resolve to phone via WAHA API
-            if "@lid" in contact_id:
-                # Get session from any existing session or use "default"
-                session_obj = db.query(WaSession).first()
-                session_name = session_obj.phone if session_obj else "default"
-                
-                # Resolve LID to phone using WAHA API
-                resolved_phone = await resolve_lid_to_phone_via_waha(contact_id, session_name, node)
-                if resolved_phone and resolved_phone != phone_number:
-                    phone_number = resolved_phone
-                    logger.info(f"-------LID_RESOLVED_TO_PHONE---{contact_id}---{phone_number}----")
+            # Get the node for this container
+            node = app.state.nodes_by_container.get(container_number)
+            
+            if not node:
+                logger.error("-------CONTAINER_NODE_NOT_FOUND---%s----", container_number)
+                continue
             
-            contact_mapping = ContactContainer(
-                contact_id=contact_id,
-                phone_number=phone_number,
-                container_number=container_number,
-                node_id=node.id
+            # Store mapping in database (if not already exists) in one race-safe round-trip
+            inserted_id = await db.scalar(
+                pg_insert(ContactContainer)
+                .values(
+                    contact_id=contact_id,
+                    phone_number=phone_number,
+                    container_number=container_number,
+                    node_id=node.id
+                )
+                .on_conflict_do_nothing(index_elements=["contact_id", "container_number"])
+                .returning(ContactContainer.id)
             )
-            db.add(contact_mapping)
-            logger.info(f"-------CONTACT_ASSIGNED---{contact_id}---{phone_number}---{container_number}----")
             
-            # If this is LID format, try to find matching phone format in JSON
-            if "@lid" in contact_id and phone_number not in json_mapping.get(str(container_number), []):
-                # LID doesn't match JSON phone numbers, log warning
-                logger.warning(f"-------LID_NOT_IN_JSON---{contact_id}---{phone_number}---{container_number}----")
+            if inserted_id is not None:
+                contact_cache.pop(contact_id, None)
+                logger.info("-------CONTACT_ASSIGNED---%s---%s---%s----", contact_id, phone_number, container_number)
+                
+                # If this is LID format, try to find matching phone format in JSON
+                if parse_contact(contact_id)[1] == LID_SUFFIX and container_number not in phone_to_containers.get(phone_number, []):
+                    # LID doesn't match JSON phone numbers, log warning
+                    logger.warning("-------LID_NOT_IN_JSON---%s---%s---%s----", contact_id, phone_number, container_number)
+            
+            containers.append((container_number, node))
         
-        containers.append((container_number, node))
-    
-    db.commit()
+        await db.commit()
     
     if not containers:
         raise Exception(f"No valid containers found for contact {contact_id}")
     
-    # Return first container for backward compatibility (you can modify to return all)
-    logger.info(f"-------FOUND_ALL_CONTAINERS---{contact_id}---{[c[0] for c in containers]}----")
-    return containers[0]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("-------FOUND_ALL_CONTAINERS---%s---%s----", contact_id, [c[0] for c in containers])
+    contact_cache[contact_id] = containers
+    return containers
 
-async def send_msg(session_phone: str, recipient_chat_id: str, text: str, db: Session):
+async def send_msg(session_phone: str, recipient_chat_id: str, text: str, client: httpx.AsyncClient):
     """Send a message via WAHA container determined by contact from database"""
-    logger.info(f"-------SEND_MSG_START---{recipient_chat_id}---{text[:30]}----")
+    logger.debug("-------SEND_MSG_START---%s---%s----", recipient_chat_id, text[:30])
     
     # Get container and node from database
-    container_number, node = await get_container_for_contact(recipient_chat_id, db)
-    
-    logger.info(f"-------SENDING_TO_CONTAINER---{recipient_chat_id}---{container_number}---{node.url}----")
-    
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{node.url}/api/sendText",
-            headers={"X-Api-Key": node.api_key},
-            json={"session": session_phone, "chatId": recipient_chat_id, "text": text},
-            timeout=30
-        )
-        response.raise_for_status()
-        logger.info(f"-------MSG_SENT_SUCCESS---{recipient_chat_id}---{container_number}----")
-        return response.json()
+    container_number, node = await get_container_for_contact(recipient_chat_id, client)
+    
+    logger.debug("-------SENDING_TO_CONTAINER---%s---%s---%s----", recipient_chat_id, container_number, node.url)
+    
+    response = await client.post(
+        f"{node.url}/api/sendText",
+        headers={"X-Api-Key": node.api_key},
+        json={"session": session_phone, "chatId": recipient_chat_id, "text": text},
+        timeout=30
+    )
+    response.raise_for_status()
+    logger.debug("-------MSG_SENT_SUCCESS---%s---%s----", recipient_chat_id, container_number)
+    return response.json()
 
 @app.post("/send")
-async def send_message_route(request: SendMessageRequest, db: Session = Depends(get_db)):
+async def send_message_route(request: SendMessageRequest, client: httpx.AsyncClient = Depends(get_http_client)):
     """Send a text message via WAHA API (container selected from database)"""
-    logger.info(f"-------API_SEND_REQUEST---{request.recipient_chat_id}---{request.text[:30]}----")
+    logger.debug("-------API_SEND_REQUEST---%s---%s----", request.recipient_chat_id, request.text[:30])
     try:
-        container_number, _ = await get_container_for_contact(request.recipient_chat_id, db)
+        container_number, _ = await get_container_for_contact(request.recipient_chat_id, client)
         result = await send_msg(
             request.session_phone,
             request.recipient_chat_id,
             request.text,
-            db
+            client
         )
-        logger.info(f"-------API_SEND_SUCCESS---{request.recipient_chat_id}---{container_number}----")
+        logger.debug("-------API_SEND_SUCCESS---%s---%s----", request.recipient_chat_id, container_number)
         return {"status": "success", "data": result, "container": container_number}
     except Exception as e:
-        logger.error(f"-------API_SEND_ERROR---{request.recipient_chat_id}---{str(e)}----")
+        logger.error("-------API_SEND_ERROR---%s---%s----", request.recipient_chat_id, e)
         return {"status": "error", "message": str(e)}, 500
 
+async def send_seen(node: WahaNode, session: str, chat_id: str, client: httpx.AsyncClient):
+    """Send a read receipt; failures are logged, never raised"""
+    try:
+        await client.post(
+            f"{node.url}/api/sendSeen",
+            headers={"X-Api-Key": node.api_key},
+            json={"session": session, "chatId": chat_id},
+            timeout=30
+        )
+        logger.debug("-------SEEN_SENT---%s---%s----", chat_id, session)
+    except Exception as e:
+        logger.warning("-------SEEN_FAILED---%s---%s----", chat_id, e)
+
+async def send_echo(container_num: int, node: WahaNode, session: str, chat_id: str, text: str, client: httpx.AsyncClient):
+    """Echo a message back to the contact from a specific container"""
+    echo_message = f"Echo (Container {container_num}): {text}"
+    logger.debug("-------ECHO_SENDING---%s---Container %s---%s---Message: %s----", chat_id, container_num, node.url, echo_message[:50])
+    response = await client.post(
+        f"{node.url}/api/sendText",
+        headers={"X-Api-Key": node.api_key},
+        json={"session": session, "chatId": chat_id, "text": echo_message},
+        timeout=30
+    )
+    response.raise_for_status()
+    logger.debug("-------ECHO_SUCCESS---%s---%s---%s----", chat_id, container_num, node.url)
+
 @app.post("/webhook/waha")
-async def webhook(request: Request, db: Session = Depends(get_db)):
-    """Webhook endpoint to receive messages from WAHA"""
+async def webhook(request: Request, background_tasks: BackgroundTasks, client: httpx.AsyncClient = Depends(get_http_client)):
+    """Webhook endpoint to receive messages from WAHA (acknowledged immediately, processed in the background)"""
     body = await request.body()
-    payload = json.loads(body)
+    payload = orjson.loads(body)
+    background_tasks.add_task(process_webhook_event, payload, client)
+    return {"ok": True}
+
+async def process_webhook_event(payload: dict, client: httpx.AsyncClient):
+    """Handle a WAHA webhook event: read receipts, echoes and status logging (opens its own short-lived DB sessions)"""
     event = payload.get("event")
     session = payload.get("session", "default")
     
-    logger.info(f"-------WEBHOOK_RECEIVED---{event}---{session}----")
+    logger.debug("-------WEBHOOK_RECEIVED---%s---%s----", event, session)
     
     if event == "message":
         # Process message
@@ -321,95 +424,66 @@ async def webhook(request: Request, db: Session = Depends(get_db)):
         text = message_payload.get("body", "")
         message_id = message_payload.get("id")
         
-        logger.info(f"-------MESSAGE_RECEIVED---{chat_id}---{session}---{text[:30]}---{message_id}----")
+        logger.debug("-------MESSAGE_RECEIVED---%s---%s---%s---%s----", chat_id, session, text[:30], message_id)
         
         # Store message in database (you can extend this)
         # store_msg(session, text, db)
         
         # Send seen (read receipt)
         try:
-            logger.info(f"-------SENDING_SEEN---{chat_id}---{session}----")
-            sess = db.query(WaSession).filter_by(phone=session).first()
-            if sess:
-                node = db.query(WahaNode).get(sess.node_id)
-            else:
-                # For default session not in DB, use first available node
-                node = db.query(WahaNode).order_by(WahaNode.active_sessions).first()
+            logger.debug("-------SENDING_SEEN---%s---%s----", chat_id, session)
+            async with SessionLocal() as db:
+                sess = (await db.execute(select(WaSession).where(WaSession.phone == session))).scalars().first()
+                if sess:
+                    node = await db.get(WahaNode, sess.node_id)
+                else:
+                    # For default session not in DB, use first available node
+                    node = (await db.execute(
+                        select(WahaNode).order_by(WahaNode.active_sessions).limit(1)
+                    )).scalars().first()
             
             if node:
-                async with httpx.AsyncClient() as client:
-                    await client.post(
-                        f"{node.url}/api/sendSeen",
-                        headers={"X-Api-Key": node.api_key},
-                        json={"session": session, "chatId": chat_id},
-                        timeout=30
-                    )
-                logger.info(f"-------SEEN_SENT---{chat_id}---{session}----")
+                fire_and_forget(send_seen(node, session, chat_id, client))
         except Exception as e:
-            logger.warning(f"-------SEEN_FAILED---{chat_id}---{str(e)}----")
+            logger.warning("-------SEEN_FAILED---%s---%s----", chat_id, e)
         
         # Echo back the message from all containers that have this contact mapped
         if text:
             try:
-                logger.info(f"-------ECHO_START---{chat_id}---{session}----")
+                logger.debug("-------ECHO_START---%s---%s----", chat_id, session)
                 
-                # Get all containers for this contact
-                contact_mappings = db.query(ContactContainer).filter_by(contact_id=chat_id).all()
-                logger.info(f"-------ECHO_CHECKING_DB---{chat_id}---Found {len(contact_mappings)} mappings----")
+                # Get all containers for this contact (cached, falls back to DB/JSON lookup)
+                containers = await get_containers_for_contact(chat_id, client)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("-------ECHO_CONTAINERS_FOUND---%s---%s----", chat_id, [c[0] for c in containers])
                 
-                if not contact_mappings:
-                    # Not in DB yet, get container (will be added to DB)
-                    logger.info(f"-------ECHO_NOT_IN_DB---{chat_id}---Calling get_container_for_contact----")
-                    container_num, node = await get_container_for_contact(chat_id, db)
-                    contact_mappings = db.query(ContactContainer).filter_by(contact_id=chat_id).all()
-                    logger.info(f"-------ECHO_AFTER_LOOKUP---{chat_id}---Found {len(contact_mappings)} mappings----")
-                
-                # Log all containers found
-                container_nums = [m.container_number for m in contact_mappings]
-                logger.info(f"-------ECHO_CONTAINERS_FOUND---{chat_id}---{container_nums}----")
-                
-                # Echo from each container with correct container number
-                for mapping in contact_mappings:
-                    node = db.query(WahaNode).get(mapping.node_id)
-                    if node:
-                        container_num = mapping.container_number
-                        if container_num is None:
-                            logger.error(f"-------CONTAINER_NUM_IS_NONE---{chat_id}---{mapping.id}----")
-                            continue
-                        echo_message = f"Echo (Container {container_num}): {text}"
-                        logger.info(f"-------ECHO_SENDING---{chat_id}---Container {container_num}---{node.url}---Message: {echo_message[:50]}----")
-                        
-                        # Send echo using the specific container
-                        async with httpx.AsyncClient() as client:
-                            response = await client.post(
-                                f"{node.url}/api/sendText",
-                                headers={"X-Api-Key": node.api_key},
-                                json={"session": session, "chatId": chat_id, "text": echo_message},
-                                timeout=30
-                            )
-                            response.raise_for_status()
-                        
-                        logger.info(f"-------ECHO_SUCCESS---{chat_id}---{container_num}---{node.url}----")
+                # Echo from all containers concurrently
+                echoes = []
+                for container_num, node in containers:
+                    if container_num is None:
+                        logger.error("-------CONTAINER_NUM_IS_NONE---%s---%s----", chat_id, node.url)
+                        continue
+                    echoes.append(send_echo(container_num, node, session, chat_id, text, client))
+                results = await asyncio.gather(*echoes, return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.error("-------ECHO_FAILED---%s---%s----", chat_id, result)
             except Exception as e:
-                logger.error(f"-------ECHO_FAILED---{chat_id}---{str(e)}----")
+                logger.error("-------ECHO_FAILED---%s---%s----", chat_id, e)
     
     elif event == "session.status":
         status = payload.get("payload", {}).get("status", "unknown")
-        logger.info(f"-------SESSION_STATUS---{session}---{status}----")
+        logger.info("-------SESSION_STATUS---%s---%s----", session, status)
     
     elif event == "message.ack":
         ack_data = payload.get("payload", {})
-        logger.info(f"-------MESSAGE_ACK---{session}---{ack_data.get('id', 'unknown')}----")
+        logger.debug("-------MESSAGE_ACK---%s---%s----", session, ack_data.get('id', 'unknown'))
     
     else:
-        logger.info(f"-------UNHANDLED_EVENT---{event}---{session}----")
-    
-    return {"ok": True}
+        logger.debug("-------UNHANDLED_EVENT---%s---%s----", event, session)
 
 # Legacy endpoint for backward compatibility
 @app.post("/bot")
-async def whatsapp_webhook_legacy(request: Request, db: Session = Depends(get_db)):
-    """Legacy webhook endpoint (redirects to new webhook)"""
-    body = await request.body()
-    data = json.loads(body)
-    return await webhook(data, db)
+async def whatsapp_webhook_legacy(request: Request, background_tasks: BackgroundTasks, client: httpx.AsyncClient = Depends(get_http_client)):
+    """Legacy webhook endpoint (forwards the raw request to the new webhook)"""
+    return await webhook(request, background_tasks, client)
@@ -1,9 +1,47 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import WahaNode
 
-def pick_node(db: Session):
-    """Pick the least-loaded WAHA node that has capacity"""
-    return db.query(WahaNode)\
-        .filter(WahaNode.active_sessions < WahaNode.max_sessions)\
-        .order_by(WahaNode.active_sessions)\
-        .first()
+def pick_node_sql(lock_clause: str):
+    """Select the least-loaded node with capacity and reserve a slot on it in one statement"""
+    return text(f"""
+        WITH cte AS (
+            SELECT id FROM waha_nodes
+            WHERE active_sessions < max_sessions
+            ORDER BY active_sessions
+            LIMIT 1
+            {lock_clause}
+        )
+        UPDATE waha_nodes SET active_sessions = active_sessions + 1
+        FROM cte WHERE waha_nodes.id = cte.id
+        RETURNING waha_nodes.*
+    """)
+
+# Skips rows other transactions are reserving, so concurrent creates spread across nodes
+PICK_NODE_SKIP_LOCKED_SQL = pick_node_sql("FOR UPDATE SKIP LOCKED")
+# Waits for locked rows; used when every candidate was locked on the first pass
+PICK_NODE_SQL = pick_node_sql("FOR UPDATE")
+
+async def reserve_node_slot(db: AsyncSession, statement):
+    """Run a pick-node statement and return the reserved node as a WahaNode (or None)"""
+    result = await db.execute(
+        select(WahaNode).from_statement(statement).execution_options(populate_existing=True)
+    )
+    return result.scalars().first()
+
+async def pick_node(db: AsyncSession):
+    """Pick the least-loaded WAHA node that has capacity and atomically increment its active_sessions"""
+    node = await reserve_node_slot(db, PICK_NODE_SKIP_LOCKED_SQL)
+    if node is None:
+        # All candidates were locked or full. Wait for the locks; a waiter re-checks only the row it
+        # waited on and returns nothing if that row just filled up, so retry once to re-sort.
+        node = await reserve_node_slot(db, PICK_NODE_SQL) or await reserve_node_slot(db, PICK_NODE_SQL)
+    return node
+
+async def release_node(db: AsyncSession, node_id: int):
+    """Give back a session slot reserved by pick_node"""
+    await db.execute(
+        update(WahaNode)
+        .where(WahaNode.id == node_id, WahaNode.active_sessions > 0)
+        .values(active_sessions=WahaNode.active_sessions - 1)
+    )